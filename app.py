@@ -1,10 +1,55 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+import orjson
 import time
 import io
+import hashlib
 import os
+import random
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# --- Constants ---
+CACHE_PATH = ".cookie_cache.sqlite3"
+CACHE_TTL_SECONDS = 30 * 86400
+
+# Per-property Google Analytics cookies (_ga_<ID>, _gat_UA-<ID>) share one analysis.
+COOKIE_ID_SUFFIX_PATTERN = re.compile(r"^(_ga|_gid|_gat)_[a-z0-9-]+$")
+
+REQUEST_TIMEOUT = (5, 30)  # (connect, read) seconds
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_CAP_SECONDS = 60.0
+
+# Request pieces that don't depend on the cookies are built once, not per call
+RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "cookieName": {"type": "STRING"},
+            "recommendedCategory": {"type": "STRING"},
+            "justification": {"type": "STRING"},
+        }, "required": ["cookieName", "recommendedCategory", "justification"],
+    },
+}
+GENERATION_CONFIG = { "responseMimeType": "application/json", "responseSchema": RESPONSE_SCHEMA, }
+PROMPT_PREFIX = "Analyze each of the cookies named in this JSON array: "
+PROMPT_SUFFIX = (
+    ". For each cookie, determine its category (e.g., 'Essential Cookies', 'Performance Cookies', "
+    "'Functional Cookies', 'Targeting Cookies', 'Unknown') "
+    "and provide a concise justification for this classification. "
+    "The justification should be no more than two lines and should summarize the cookie's function and why it belongs to the assigned category. "
+    "Return one result per cookie and use the exact cookie name given as cookieName."
+)
+
+DUPLICATE_PREVIEW_ROWS = 500
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -96,107 +141,321 @@ with st.sidebar:
     st.header("Processing Controls")
     st.caption("Adjust the processing speed and retry attempts.")
     MAX_RETRIES = st.slider("Max Retries per Cookie", 5, 10, 5) 
-    CHUNK_SIZE_PAUSE = st.slider("Pause After # Cookies", 5, 100, 5) 
-    PAUSE_DURATION = st.slider("Pause Duration (seconds)", 10, 60, 10)
+    MAX_CONCURRENCY = st.slider("Concurrent API Requests", 1, 16, 8)
+    REQUESTS_PER_MINUTE = st.slider("Max Requests per Minute", 5, 300, 15)
+    BATCH_SIZE = st.slider("Cookies per API Request", 1, 50, 20)
 
 
 # --- Core Functions ---
-def get_cookie_details(_cookie_name, retries):
-    headers = {"Content-Type": "application/json"}
-    response_schema = {
-        "type": "OBJECT",
-        "properties": {
-            "cookieName": {"type": "STRING"},
-            "recommendedCategory": {"type": "STRING"},
-            "justification": {"type": "STRING"},
-        }, "required": ["cookieName", "recommendedCategory", "justification"],
-    }
-    prompt_text = (
-        f"Analyze the cookie named '{_cookie_name}'. "
-        f"Determine its category (e.g., 'Essential Cookies', 'Performance Cookies', "
-        f"'Functional Cookies', 'Targeting Cookies', 'Unknown') "
-        f"and provide a concise justification for this classification. "
-        f"The justification should be no more than two lines and should summarize the cookie's function and why it belongs to the assigned category."
+@st.cache_resource
+def get_http_session():
+    # One pooled keep-alive session shared across reruns, so only the first
+    # request to the Gemini API pays the TCP+TLS handshake.
+    session = requests.Session()
+    session.headers.update({"Content-Type": "application/json"})
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32)
+    session.mount("https://", adapter)
+    return session
+
+SESSION = get_http_session()
+
+class RateLimiter:
+    """Thread-safe token bucket allowing `rate` requests every `period` seconds."""
+
+    def __init__(self, rate, period=60.0):
+        self.period = period
+        self.capacity = rate
+        self.fill_rate = rate / period
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.capacity = rate
+            self.fill_rate = rate / self.period
+            self.tokens = min(self.tokens, rate)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.fill_rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Called on a 429 so every worker backs off, not just the one that was throttled.
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+@st.cache_resource
+def get_rate_limiter(api_key):
+    # The quota belongs to the API key, so every session and run using it shares one bucket.
+    return RateLimiter(REQUESTS_PER_MINUTE)
+
+class ResultCache:
+    """SQLite-backed cache of Gemini results keyed by canonical cookie name."""
+
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cookie_results "
+            "(key TEXT PRIMARY KEY, result TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self.conn.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT result FROM cookie_results WHERE key = ? AND expires_at > ?",
+                (str(key), time.time()),
+            ).fetchone()
+        return orjson.loads(row[0]) if row else None
+
+    def set(self, key, result):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cookie_results (key, result, expires_at) VALUES (?, ?, ?)",
+                (str(key), orjson.dumps(result).decode(), time.time() + self.ttl),
+            )
+            self.conn.commit()
+
+@st.cache_resource
+def get_result_cache():
+    return ResultCache(CACHE_PATH, CACHE_TTL_SECONDS)
+
+CACHE = get_result_cache()
+
+def canonicalize_cookie_names(cookie_names):
+    return cookie_names.str.strip().str.lower().str.replace(COOKIE_ID_SUFFIX_PATTERN, r"\1_*", regex=True)
+
+def get_upload_hash(uploaded_file):
+    # Hash each upload once; later reruns reuse the digest via the uploader's file_id
+    cached = st.session_state.get("upload_hash")
+    if cached is None or cached[0] != uploaded_file.file_id:
+        cached = (uploaded_file.file_id, hashlib.md5(uploaded_file.getvalue()).hexdigest())
+        st.session_state["upload_hash"] = cached
+    return cached[1]
+
+@st.cache_data(show_spinner=False)
+def load_and_dedupe(file_hash, _file_bytes):
+    # Cached on file_hash only; the leading underscore keeps Streamlit from rehashing the bytes
+    # Read file with no header and skipping the first row. Cells are read as text, since a
+    # column can mix numbers and strings (e.g. cookie 12345 followed by _ga).
+    df = pd.read_excel(io.BytesIO(_file_bytes), header=None, skiprows=1, engine="calamine", dtype=str)
+    # Assign clear column names
+    df.columns = ["Cookie Name", "Domain Category"]
+    # Compact dtypes keep large uploads small and speed up dedup and merge
+    df["Cookie Name"] = df["Cookie Name"].astype("string[pyarrow]")
+    domain_category = df["Domain Category"].astype("string[pyarrow]")
+    # An all-blank column has no categories to build, so it stays a plain string column
+    df["Domain Category"] = domain_category.astype("category") if domain_category.notna().any() else domain_category
+
+    # Dedupe on the canonical name so case variants and per-property IDs cost one API call
+    df["_key"] = canonicalize_cookie_names(df["Cookie Name"])
+    duplicate_mask = df.duplicated(subset="_key", keep=False)
+    duplicate_cookies_df = df[duplicate_mask].sort_values(by=["_key", "Cookie Name"])
+    unique_cookies_df = df.drop_duplicates(subset=["_key"])
+    return df, duplicate_cookies_df, unique_cookies_df
+
+@st.cache_data(show_spinner=False)
+def to_arrow_table(df):
+    # st.dataframe would otherwise redo the pandas -> Arrow conversion on every rerun
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+def normalize_cookie_name(cookie_name):
+    return str(cookie_name).strip().lower()
+
+def is_timeout(error):
+    # A read timeout while the body downloads surfaces as a ConnectionError wrapping
+    # urllib3's ReadTimeoutError rather than as requests' Timeout.
+    if isinstance(error, requests.exceptions.Timeout):
+        return True
+    return isinstance(error, requests.exceptions.ConnectionError) and any(
+        isinstance(arg, ReadTimeoutError) for arg in error.args
     )
-    payload = {
-        "contents": [{"role": "user", "parts": [{"text": prompt_text}]}],
-        "generationConfig": { "responseMimeType": "application/json", "responseSchema": response_schema, },
-    }
-    for attempt in range(retries):
+
+def get_retry_after(response, default=60):
+    try:
+        return float(response.headers["Retry-After"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return default
+
+def get_cookie_details_batch(cookies, retries, limiter):
+    # `cookies` holds (canonical key, cookie name) pairs; results are returned by key.
+    # Common cookies (_ga, _gid, _fbp, ...) recur across sites, so skip the API when we can.
+    details = {}
+    pending = []
+    for key, cookie_name in cookies:
+        cached = CACHE.get(key)
+        if cached:
+            details[key] = cached
+        else:
+            pending.append((key, cookie_name))
+    if not pending:
+        return details, 0
+
+    # Decorrelated jitter keeps concurrent batches from retrying in lockstep
+    backoff = BACKOFF_BASE_SECONDS
+    timeouts = 0
+    for _ in range(retries):
+        # Rebuilt each attempt so retries only ask about cookies still missing a result
+        prompt_text = PROMPT_PREFIX + orjson.dumps([str(cookie_name) for _, cookie_name in pending]).decode() + PROMPT_SUFFIX
+        payload = {
+            "contents": [{"role": "user", "parts": [{"text": prompt_text}]}],
+            "generationConfig": GENERATION_CONFIG,
+        }
         try:
-            response = requests.post(API_URL, headers=headers, data=json.dumps(payload))
+            limiter.acquire()
+            # The session already sends Content-Type: application/json. Error bodies are read
+            # too (they are small), which lets the keep-alive connection go back to the pool.
+            response = SESSION.post(API_URL, data=orjson.dumps(payload), timeout=REQUEST_TIMEOUT)
+            if response.status_code == 429:
+                limiter.pause(get_retry_after(response) + random.uniform(0, 5))
+                continue
             response.raise_for_status()
-            response_data = response.json()
+            response_data = orjson.loads(response.content)
             if "candidates" in response_data and response_data["candidates"]:
-                return json.loads(response_data["candidates"][0]["content"]["parts"][0]["text"])
-            else: return None
-        except requests.exceptions.RequestException as e:
-            status_code = getattr(e.response, "status_code", None)
-            if status_code == 429:
-                time.sleep(60)
-                continue
-            time.sleep(2**attempt)
-    return {"cookieName": _cookie_name, "recommendedCategory": "Error", "justification": f"API call failed after {retries} attempts."}
+                results = orjson.loads(response_data["candidates"][0]["content"]["parts"][0]["text"])
+                # Match results back by name since the model may reorder them; the echoed name
+                # may differ in case or whitespace. With one result per cookie, fall back to order.
+                by_name = {normalize_cookie_name(result.get("cookieName", "")): result for result in results}
+                positional = len(results) == len(pending)
+                missing = []
+                for index, (key, cookie_name) in enumerate(pending):
+                    result = by_name.get(normalize_cookie_name(cookie_name))
+                    if result is None and positional:
+                        result = results[index]
+                    if result:
+                        CACHE.set(key, result)
+                        details[key] = result
+                    else:
+                        missing.append((key, cookie_name))
+                pending = missing
+                if pending:
+                    continue
+            return details, timeouts
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+            # Garbled or truncated bodies are retried like request errors.
+            # Timeouts back off like any other failure but are counted for the UI
+            if is_timeout(e):
+                timeouts += 1
+            time.sleep(backoff)
+            backoff = min(BACKOFF_CAP_SECONDS, random.uniform(BACKOFF_BASE_SECONDS, backoff * 3))
+    for key, cookie_name in pending:
+        details[key] = {"cookieName": cookie_name, "recommendedCategory": "Error", "justification": f"API call failed after {retries} attempts."}
+    return details, timeouts
+
+def reconcile_categories(df):
+    # Vectorized over all analyzed cookies at once instead of branching per row.
+    domain_category = df["Domain Category"].astype(object)
+    gemini_category = df["Gemini Category"]
+    gemini_justification = df["Gemini Justification"]
+    combined_category = domain_category.astype(str).str.cat(gemini_category.astype(str), sep="/", na_rep="nan")
+
+    no_result = gemini_category.isna()
+    same_category = gemini_category == domain_category
+    gemini_unknown = gemini_category == "Unknown"
+    conditions = [
+        no_result,
+        same_category & gemini_unknown,
+        same_category,
+        gemini_unknown,
+        domain_category != "Unknown",
+    ]
+    category_choices = [None, gemini_category, gemini_category, domain_category, combined_category]
+    justification_choices = [
+        None,
+        "Need confirmation from Client",
+        "N/A",
+        "N/A",
+        "Depending on the website's use case it can be classified as " + combined_category + ". " + gemini_justification.astype(str),
+    ]
+
+    reconciled_df = df[["Cookie Name", "Domain Category"]].copy()
+    reconciled_df["Recommended Category"] = np.select(conditions, [np.asarray(c, dtype=object) for c in category_choices], default=gemini_category.to_numpy(dtype=object))
+    reconciled_df["Justification"] = np.select(conditions, [np.asarray(c, dtype=object) for c in justification_choices], default=gemini_justification.to_numpy(dtype=object))
+    return reconciled_df
+
+def analyze_batch(batch, limiter):
+    details, timeouts = get_cookie_details_batch(batch, retries=MAX_RETRIES, limiter=limiter)
+    return [details.get(key) for key, _ in batch], timeouts
 
 def process_dataframe(df):
-    # Use column names instead of indices for clarity
-    cookie_records = [tuple(row) for row in df[["Cookie Name", "Domain Category"]].itertuples(index=False)]
+    # Pair the underlying arrays directly instead of building a namedtuple per row
+    keys = df["_key"].to_numpy()
+    cookie_records = list(zip(keys, df["Cookie Name"].to_numpy()))
     
     total_cookies = len(cookie_records)
     st.info(f"Found {total_cookies} unique cookies to process.")
     
     progress_bar = st.progress(0, text="Initializing...")
     status_text = st.empty()
-    results_list = []
+    processed = 0
+    timeout_count = 0
+    update_every = max(1, total_cookies // 100)
 
-    for index, (cookie_name, domain_category) in enumerate(cookie_records):
-        status_text.text(f"🔄 Processing {index + 1}/{total_cookies}: {cookie_name}")
-        try:
-            time.sleep(1) # Basic rate limiting
-            api_details = get_cookie_details(cookie_name, retries=MAX_RETRIES) 
-            
-            if api_details:
-                gemini_category = api_details.get("recommendedCategory", "Unknown")
-                gemini_justification = api_details.get("justification", "")
-                final_category = gemini_category
-                final_justification = gemini_justification
-
-                if gemini_category == domain_category:
-                    if gemini_category == "Unknown":
-                        final_justification = "Need confirmation from Client"
-                    else:
-                        final_justification = "N/A"
-                else: 
-                    if gemini_category == "Unknown":
-                        final_category = domain_category
-                        final_justification = "N/A"
-                    elif domain_category != "Unknown":
-                        final_category = f"{domain_category}/{gemini_category}"
-                        final_justification = (f"Depending on the website's use case it can be classified as " f"{domain_category}/{gemini_category}. {gemini_justification}")
-                
-                final_result = {
-                    "Cookie Name": cookie_name, 
-                    "Domain Category": domain_category, 
-                    "Recommended Category": final_category, 
-                    "Justification": final_justification
-                }
-                results_list.append(final_result)
-        except Exception as e:
-            results_list.append({
-                "Cookie Name": cookie_name, 
-                "Domain Category": domain_category, 
-                "Recommended Category": "Processing Error", 
-                "Justification": str(e)
-            })
-            
-        progress_bar.progress((index + 1) / total_cookies, text=f"Processed {index + 1}/{total_cookies}")
-        
-        if (index + 1) % CHUNK_SIZE_PAUSE == 0 and (index + 1) < total_cookies:
-            status_text.text(f"⏸️ Pausing for {PAUSE_DURATION} seconds to manage rate limits...")
-            time.sleep(PAUSE_DURATION)
+    # Results are filled in by position as batches complete; None means no result yet
+    gemini_categories = np.empty(total_cookies, dtype=object)
+    gemini_justifications = np.empty(total_cookies, dtype=object)
+    error_messages = np.empty(total_cookies, dtype=object)
+
+    limiter = get_rate_limiter(GEMINI_API_KEY)
+    limiter.set_rate(REQUESTS_PER_MINUTE)
+    batches = [(start, cookie_records[start:start + BATCH_SIZE]) for start in range(0, total_cookies, BATCH_SIZE)]
+
+    # API calls run on worker threads; all Streamlit updates stay on this thread.
+    executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+    try:
+        futures = {executor.submit(analyze_batch, batch, limiter): (start, batch) for start, batch in batches}
+        for future in as_completed(futures):
+            start, batch = futures[future]
+            try:
+                batch_details, batch_timeouts = future.result()
+                timeout_count += batch_timeouts
+                for index, api_details in enumerate(batch_details, start=start):
+                    if api_details:
+                        gemini_categories[index] = api_details.get("recommendedCategory", "Unknown")
+                        gemini_justifications[index] = api_details.get("justification", "")
+            except Exception as e:
+                error_messages[start:start + len(batch)] = str(e)
+
+            # Each update is a websocket message, so advance the bar in ~100 steps at most
+            reported_before = processed // update_every
+            processed += len(batch)
+            if processed // update_every > reported_before or processed == total_cookies:
+                progress_bar.progress(processed / total_cookies, text=f"🔄 Processed {processed}/{total_cookies}: {batch[-1][1]}")
+    finally:
+        # A rerun or stop raises out of the loop above; drop queued batches instead of
+        # waiting for them (and their API calls) to finish.
+        executor.shutdown(wait=False, cancel_futures=True)
 
     status_text.success("🎉 All cookies have been processed!")
-    return pd.DataFrame(results_list)
+    # Worker threads can't touch session state, so timeouts are tallied here
+    st.session_state["timeout_count"] = st.session_state.get("timeout_count", 0) + timeout_count
+    if timeout_count:
+        st.warning(f"⏱️ {timeout_count} API requests timed out during this run; timed-out requests are retried with backoff.")
+    analyzed = pd.notna(gemini_categories)
+    failed = pd.notna(error_messages)
+
+    # Raw Gemini answers keyed by canonical name; each input row is reconciled against
+    # its own Domain Category after the lookup.
+    result_map = dict(zip(keys[analyzed], zip(gemini_categories[analyzed], gemini_justifications[analyzed])))
+    error_map = dict(zip(keys[failed], error_messages[failed]))
+    return result_map, error_map
 
 # --- File Uploader and Main Logic ---
 uploaded_file = st.file_uploader("Choose an Excel file", type=["xlsx"], label_visibility="collapsed")
@@ -206,58 +465,55 @@ if uploaded_file:
         st.error("Please enter your Gemini API Key in the sidebar to begin.")
     else:
         try:
-            # Read file with no header and skipping the first row
-            input_df = pd.read_excel(uploaded_file, header=None, skiprows=1)
-            # Assign clear column names
-            input_df.columns = ["Cookie Name", "Domain Category"]
-
-            # --- Preprocessing Step: Identify and display duplicates ---
-            duplicate_mask = input_df.duplicated(subset="Cookie Name", keep=False)
-            duplicate_cookies_df = input_df[duplicate_mask].sort_values(by="Cookie Name")
+            # --- Preprocessing Step: Identify duplicates (cached across reruns) ---
+            input_df, duplicate_cookies_df, unique_cookies_df = load_and_dedupe(get_upload_hash(uploaded_file), uploaded_file.getvalue())
 
             if not duplicate_cookies_df.empty:
-                st.warning(f"⚠️ Found {len(duplicate_cookies_df)} duplicate cookie entries.")
+                group_counts = duplicate_cookies_df["_key"].value_counts(sort=False, dropna=False).rename_axis("Matched As").reset_index(name="Entries")
+                st.warning(f"⚠️ Found {len(duplicate_cookies_df)} duplicate cookie entries, collapsing into {len(group_counts)} unique cookies.")
+                st.caption("Cookie names are matched case-insensitively, and per-property IDs such as `_ga_ABC123` are grouped as `_ga_*`.")
                 st.write("### Duplicate Cookies Found:")
-                st.dataframe(duplicate_cookies_df.reset_index().rename(columns={'index': 'Original Row (1-based)'}))
+                duplicates_display_df = duplicate_cookies_df.drop(columns="_key")
+                if len(duplicates_display_df) > DUPLICATE_PREVIEW_ROWS and not st.toggle(f"Show all {len(duplicates_display_df)} duplicate entries"):
+                    duplicates_display_df = duplicates_display_df.head(DUPLICATE_PREVIEW_ROWS)
+                st.dataframe(to_arrow_table(duplicates_display_df.reset_index().rename(columns={'index': 'Original Row (1-based)'})))
+                st.dataframe(group_counts, hide_index=True)
                 st.write("Removing these duplicates for analysis to prevent redundant API calls.")
             else:
                 st.success("✅ No duplicate cookie entries found. Proceeding with analysis.")
             
             if st.button("Start Analysis", type="primary", use_container_width=True):
                 with st.spinner("Analyzing cookies... This may take a while."):
-                    # --- Preprocessing Step: Remove duplicates for API processing ---
-                    unique_cookies_df = input_df.drop_duplicates(subset=["Cookie Name"]).copy()
-                    
                     # Process only the unique cookies
-                    analysis_results_df = process_dataframe(unique_cookies_df)
-
-                    # --- NEW: Merge the analysis results back to the original dataframe ---
-                    # This ensures the output file has the same number of rows as the input
-                    # and duplicates get the same analysis result.
-                    
-                    # We only need the new analysis columns from the results
-                    result_columns = ["Cookie Name", "Recommended Category", "Justification"]
-                    
-                    # Use a left merge to map results back to the original full list
-                    output_df = pd.merge(
-                        input_df, 
-                        analysis_results_df[result_columns], 
-                        on="Cookie Name", 
-                        how="left"
-                    )
+                    result_map, error_map = process_dataframe(unique_cookies_df)
+
+                    # --- Map the analysis results back to the original dataframe ---
+                    # This ensures the output file has the same number of rows as the input.
+                    # Duplicates share the Gemini answer, but each row is reconciled against
+                    # its own Domain Category.
+                    analysis_df = input_df.drop(columns="_key")
+                    mapped_results = input_df["_key"].map(result_map).astype(object)
+                    analysis_df["Gemini Category"] = mapped_results.str[0]
+                    analysis_df["Gemini Justification"] = mapped_results.str[1]
+                    output_df = reconcile_categories(analysis_df)
+
+                    error_messages = input_df["_key"].map(error_map)
+                    failed = error_messages.notna()
+                    output_df.loc[failed, "Recommended Category"] = "Processing Error"
+                    output_df.loc[failed, "Justification"] = error_messages[failed]
+                    output_df["Recommended Category"] = output_df["Recommended Category"].astype("category")
 
                     st.write("### Analysis Results")
                     st.dataframe(output_df)
 
                     # Prepare for download
                     output_buffer = io.BytesIO()
-                    with pd.ExcelWriter(output_buffer, engine="xlsxwriter") as writer:
-                        # Write the dataframe to the Excel file
-                        output_df.to_excel(writer, index=False, sheet_name="Results")
-                        
-                        # Get the xlsxwriter workbook and worksheet objects
+                    # constant_memory flushes each row as soon as the next one starts, so rows
+                    # must be written strictly top to bottom (to_excel writes column by column).
+                    with pd.ExcelWriter(output_buffer, engine="xlsxwriter", engine_kwargs={"options": {"constant_memory": True}}) as writer:
+                        # Get the xlsxwriter workbook and add the results worksheet
                         workbook = writer.book
-                        worksheet = writer.sheets["Results"]
+                        worksheet = workbook.add_worksheet("Results")
                         
                         # Define a format for the header
                         header_format = workbook.add_format({
@@ -268,13 +524,15 @@ if uploaded_file:
                             'border': 1
                         })
                         
-                        # Write the header row with the defined format
-                        for col_num, value in enumerate(output_df.columns.values):
-                            worksheet.write(0, col_num, value, header_format)
-                            
                         # Set column widths for better readability
                         worksheet.set_column('A:D', 25)
 
+                        # Write the header row with the defined format, then stream the data rows
+                        worksheet.write_row(0, 0, output_df.columns.tolist(), header_format)
+                        export_df = output_df.astype(object).where(output_df.notna(), None)
+                        for row_num, row in enumerate(export_df.itertuples(index=False, name=None), start=1):
+                            worksheet.write_row(row_num, 0, row)
+
                     st.download_button(
                         label="📥 Download Results as Excel", 
                         data=output_buffer.getvalue(), 